@@ -0,0 +1,106 @@
+"""
+Large generated datasets, streaming reads and per-test memory ceilings.
+
+Rows are generated inside the test's transaction, so they are rolled back
+with everything else. `stream` reads results through a server-side cursor
+in batches instead of materializing them, and `MemoryCeiling` measures the
+growth of traced Python allocations and peak RSS while a test runs.
+"""
+import re
+import resource
+import sys
+import tracemalloc
+
+from sqlalchemy import text
+
+DEFAULT_ROWS = 100000
+BATCH_SIZE = 1000
+
+SIZE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMG]?)B?$', re.IGNORECASE)
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def parse_size(value):
+    if value is None or isinstance(value, int):
+        return value
+    match = SIZE_RE.match(str(value).strip())
+    if not match:
+        raise ValueError('invalid size: %r' % (value,))
+    number, unit = match.groups()
+    return int(float(number) * UNITS[unit.upper()])
+
+
+def generate(conn, table, rows, prefix='bulk'):
+    """Insert `rows` rows with unique names into `table`; return `rows`."""
+    if conn.engine.dialect.name == 'postgresql':
+        conn.execute(text(
+            "INSERT INTO %s (name, created_by) "
+            "SELECT :prefix || '-' || g, :prefix "
+            "FROM generate_series(1, :rows) AS g" % table.name
+        ), prefix=prefix, rows=rows)
+    else:
+        for start in range(0, rows, BATCH_SIZE):
+            conn.execute(table.insert(), [
+                {'name': '%s-%d' % (prefix, i + 1), 'created_by': prefix}
+                for i in range(start, min(start + BATCH_SIZE, rows))
+            ])
+    return rows
+
+
+def stream(conn, stmt, batch_size=BATCH_SIZE):
+    """Yield result rows of `stmt` using a server-side cursor."""
+    result = conn.execution_options(stream_results=True).execute(stmt)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+class MemoryCeiling:
+    """
+    Measure memory growth between `start` and `check`.
+
+    `traced` limits the peak of Python allocations above the starting
+    point (via tracemalloc). `rss` limits growth of the process's peak
+    RSS, which can only detect a test pushing the high-water mark up.
+    """
+
+    def __init__(self, traced=None, rss=None):
+        self.traced = parse_size(traced)
+        self.rss = parse_size(rss)
+
+    def start(self):
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.traced_before = tracemalloc.get_traced_memory()[0]
+        self.rss_before = max_rss()
+
+    def check(self):
+        """Stop measuring; return list of exceeded limits as strings."""
+        traced = tracemalloc.get_traced_memory()[1] - self.traced_before
+        rss = max_rss() - self.rss_before
+        if self.started_tracing:
+            tracemalloc.stop()
+        problems = []
+        if self.traced is not None and traced > self.traced:
+            problems.append('traced memory grew by %d bytes (limit %d)' % (
+                traced, self.traced))
+        if self.rss is not None and rss > self.rss:
+            problems.append('peak RSS grew by %d bytes (limit %d)' % (
+                rss, self.rss))
+        return problems
@@ -0,0 +1,96 @@
+"""
+Commit interception for the `session` fixture.
+
+Normally a `commit()` inside a test ends the session's nested transaction,
+and the `session` fixture immediately begins a new one, so every commit
+costs a RELEASE SAVEPOINT plus a SAVEPOINT round-trip. A savepoint at a
+commit is only needed if something written after it is rolled back later,
+so with interception `commit()` just flushes and marks a checkpoint as
+pending. Right before the next write (or rollback) that follows one or
+more commits, a single SAVEPOINT is stacked on the previous ones, and
+they all go away with the test's transaction. Commits with no writes in
+between cost nothing, and the others cost one round trip instead of two.
+
+Only the innermost checkpoint is ever rolled back to, so the stack is
+kept at most `MAX_CHECKPOINTS` deep: past that, the innermost checkpoint
+is released before the next one is stacked (RELEASE plus SAVEPOINT, as
+without interception). Every savepoint that sees a write is still a
+subtransaction of the test's transaction, and PostgreSQL slows down once
+a transaction has more than 64 of them, so tests that commit very often
+will still hit that, with or without interception.
+
+Writes that bypass both the session and its connection's `execute()`
+(e.g. raw DBAPI cursors) are not seen and don't trigger the checkpoint.
+"""
+from sqlalchemy import event
+from sqlalchemy.schema import DDLElement
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+MAX_CHECKPOINTS = 8
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'CREATE', 'ALTER', 'DROP',
+          'TRUNCATE', 'COPY', 'WITH')
+
+
+def is_write(clause):
+    if isinstance(clause, (UpdateBase, DDLElement)):
+        return True
+    if isinstance(clause, (str, TextClause)):
+        words = str(clause).split(None, 1)
+        return bool(words) and words[0].upper() in WRITES
+    return False
+
+
+class CommitInterceptor:
+    """Replace `commit()` of `session` with a flush and a lazy checkpoint."""
+
+    def __init__(self, session, conn):
+        self.session = session
+        self.conn = conn
+        self.pending = False
+        self.commits = 0
+        self.checkpoints = []  # stacked nested transactions, innermost last
+        session.commit = self.commit
+        session.rollback = self.rollback
+        session.info['commit_interceptor'] = self
+        event.listen(session, 'before_flush', self.before_flush)
+        event.listen(conn, 'before_execute', self.before_execute)
+
+    def commit(self):
+        self.session.flush()
+        self.pending = True
+        self.commits += 1
+
+    def rollback(self):
+        self.checkpoint()
+        if self.checkpoints and self.session.transaction is self.checkpoints[-1]:
+            # roll back to the last checkpoint, and keep it for later rollbacks
+            type(self.session).rollback(self.session)
+            self.checkpoints[-1] = self.session.begin_nested()
+        else:
+            type(self.session).rollback(self.session)
+
+    def checkpoint(self):
+        """Issue the savepoint for the last intercepted commit, if any."""
+        if self.pending:
+            self.pending = False
+            if len(self.checkpoints) >= MAX_CHECKPOINTS \
+                    and self.session.transaction is self.checkpoints[-1]:
+                type(self.session).commit(self.session)  # RELEASE SAVEPOINT
+                self.checkpoints.pop()
+            self.checkpoints.append(self.session.begin_nested())
+
+    def before_flush(self, session, flush_context, instances):
+        self.checkpoint()
+
+    def before_execute(self, conn, clauseelement, multiparams, params):
+        if self.pending and not self.session._flushing and is_write(clauseelement):
+            self.checkpoint()
+
+    def remove(self):
+        event.remove(self.conn, 'before_execute', self.before_execute)
+        event.remove(self.session, 'before_flush', self.before_flush)
+        del self.session.info['commit_interceptor']
+        del self.session.rollback
+        del self.session.commit
@@ -0,0 +1,121 @@
+"""
+Several real connections for concurrency tests, all rolled back at teardown.
+
+Each connection runs in its own transaction that is rolled back when the
+test ends, so the seeded state is all that any of them can see besides
+their own writes. With `snapshot=True` each transaction imports a snapshot
+exported from the test's transaction on `db.connection`, so all of them
+see exactly the same committed state the test started with.
+
+Either way they only see committed rows: the state seeded once by the
+`db` fixture. Rows the test writes itself on `db.connection` (in the test
+body, or with the `bulk_things` fixture) are never committed, and an
+exported snapshot doesn't include the exporting transaction's own
+uncommitted writes, so none of the extra connections can see them; such
+rows only show up as lock waits when the others touch the same keys.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import queue
+
+from sqlalchemy import event, text
+from sqlalchemy.orm.session import Session
+
+DEFAULT_CONNECTIONS = 4
+
+
+def resolve(marker=None):
+    """Return (number of connections, use snapshot) from `db_connections`."""
+    kw = marker.kwargs if marker is not None else {}
+    n = kw.get('n', marker.args[0] if marker is not None and marker.args
+               else DEFAULT_CONNECTIONS)
+    return int(n), bool(kw.get('snapshot', False))
+
+
+def export_snapshot(conn):
+    return conn.execute(text('SELECT pg_export_snapshot()')).scalar()
+
+
+def open_connections(engine, n, snapshot=None):
+    """Return list of (connection, transaction) pairs."""
+    opened = []
+    try:
+        for _ in range(n):
+            conn = engine.connect()
+            opened.append((conn, conn.begin()))
+            if snapshot is not None:
+                conn.execute(text(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'))
+                conn.execute(text("SET TRANSACTION SNAPSHOT '%s'" % snapshot))
+    except Exception:
+        close_connections(opened)
+        raise
+    return opened
+
+
+def close_connections(opened):
+    for conn, tx in opened:
+        try:
+            if tx.is_active:
+                tx.rollback()
+        finally:
+            conn.close()
+
+
+def bind_session(conn):
+    """
+    Return session on `conn` whose commits only release savepoints.
+
+    This is the same arrangement the `session` fixture uses for the shared
+    connection, so code calling `commit()` can't escape the outer
+    transaction of `conn`.
+    """
+    s = Session(bind=conn)
+    s.begin_nested()
+
+    @event.listens_for(s, 'after_transaction_end')
+    def after_transaction_end(sess, tx):
+        if tx.nested and not tx._parent.nested:
+            sess.begin_nested()
+
+    s.info['after_transaction_end'] = after_transaction_end
+    return s
+
+
+def unbind_session(s):
+    event.remove(s, 'after_transaction_end', s.info.pop('after_transaction_end'))
+    s.close()
+
+
+class SessionPool:
+    """
+    Thread pool whose tasks each run with one of N bound sessions.
+
+    A submitted callable gets a session as its first argument; no two
+    tasks use the same session at the same time.
+    """
+
+    def __init__(self, connections):
+        self.sessions = [bind_session(conn) for conn in connections]
+        self._idle = queue.Queue()
+        for s in self.sessions:
+            self._idle.put(s)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.sessions))
+
+    def _run(self, fn, args, kwargs):
+        s = self._idle.get()
+        try:
+            return fn(s, *args, **kwargs)
+        finally:
+            self._idle.put(s)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def map(self, fn, *iterables):
+        return self._executor.map(lambda *args: self._run(fn, args, {}),
+                                  *iterables)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        for s in self.sessions:
+            unbind_session(s)
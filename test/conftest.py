@@ -1,15 +1,21 @@
 import pprint
 import sys
+import warnings
 from types import SimpleNamespace
 
 import pytest
 
 from sqlalchemy import event, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import InternalError, ResourceClosedError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session as OrmSession
 
-from .models import Base, Thing, make_engine
+from . import (
+    bulk, commits, concurrency, impact, locks, matrix, migrations, plans,
+    reaper, schema, trace,
+)
+from .models import CONNECT_URL, Base, Thing, make_engine
 
 DEFAULT_NAME = 'name-default'
 DEFAULT_CREATED_BY = 'user-default'
@@ -22,6 +28,238 @@ AUTOUSE_SESSION = True
 Session = sessionmaker()
 
 
+def pytest_addoption(parser):
+    parser.addini('db_lock_timeout', 'default lock_timeout for each test')
+    parser.addini('db_statement_timeout',
+                  'default statement_timeout for each test')
+    parser.addini('db_intercept_commit', type='bool', default=False,
+                  help='make session.commit() in tests a flush plus a lazy '
+                       'checkpoint instead of a savepoint cycle')
+    parser.addini('db_migrations',
+                  'alembic.ini whose migrations create the schema, instead '
+                  'of Base.metadata.create_all')
+    group = parser.getgroup('sqlalch')
+    group.addoption('--db-explain', choices=plans.MODES, default=None,
+                    help='check query plans of tests marked db_explain '
+                         'against stored baselines (or update them; run '
+                         'with update first to create the baselines)')
+    parser.addini('db_explain_baselines', 'file with stored query plans',
+                  default='test/plans.json')
+    parser.addini('db_explain_cost_factor',
+                  'fail/warn when plan cost exceeds baseline by this factor',
+                  default='2.0')
+    group.addoption('--db-keep-schema', action='store_true', default=False,
+                    help='keep tables between runs; only drop and create '
+                         'them again when Base.metadata changed')
+    group.addoption('--db-tables', action='append', default=[],
+                    metavar='NAMES',
+                    help='only run tests recorded as touching these '
+                         'comma-separated tables or model classes, plus '
+                         'tests with no record yet')
+    group.addoption('--db-drivers', action='append', default=[],
+                    metavar='NAMES',
+                    help='run the suite once per comma-separated driver (%s) '
+                         'and show outcome and DB time side by side'
+                         % ', '.join(sorted(matrix.DRIVERS)))
+    group.addoption('--db-trace', metavar='PATH', default=None,
+                    help='write Chrome trace / Perfetto JSON timeline of '
+                         'transactions and statements to PATH')
+
+
+def pytest_configure(config):
+    config.sqlalch_impact = {}
+    try:
+        drivers = matrix.parse(config.getoption('--db-drivers'))
+    except ValueError as e:
+        raise pytest.UsageError(str(e))
+    matrix.results = matrix.Results(drivers) if drivers else None
+    if config.getoption('--db-trace'):
+        trace.current = trace.Trace(worker_id(config))
+    mode = config.getoption('--db-explain')
+    if mode is not None:
+        config.sqlalch_plans = plans.Baselines(
+            str(config.rootdir.join(config.getini('db_explain_baselines'))),
+            mode,
+            float(config.getini('db_explain_cost_factor')),
+        )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_sessionstart(session):
+    config = session.config
+    # drop clones left behind by runs that ended before their teardown did
+    if migrations_path(config) is not None and worker_output(config) is None:
+        url = make_url(CONNECT_URL)
+        admin = migrations.admin_engine(url)
+        try:
+            reaper.reap(admin, migrations.clone_prefix(url))
+        finally:
+            admin.dispose()
+
+
+def pytest_sessionfinish(session):
+    config = session.config
+    output = worker_output(config)
+    baselines = getattr(config, 'sqlalch_plans', None)
+    if baselines is not None:
+        if output is not None:
+            output['sqlalch_plans'] = baselines.changed
+        else:
+            baselines.save()
+    if output is not None:
+        output['sqlalch_impact'] = config.sqlalch_impact
+    elif getattr(config, 'cache', None) is not None:
+        recorded = config.cache.get(impact.CACHE_KEY, {})
+        impact.merge(recorded, config.sqlalch_impact)
+        config.cache.set(impact.CACHE_KEY, recorded)
+    if trace.current is not None:
+        if output is not None:
+            output['sqlalch_trace'] = trace.current.events
+        else:
+            trace.write(config.getoption('--db-trace'), trace.current.events)
+
+
+def pytest_unconfigure(config):
+    # daemon threads are killed at exit; let teardowns in flight finish
+    reaper.wait_all()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    output = node_output(node)
+    baselines = getattr(node.config, 'sqlalch_plans', None)
+    if baselines is not None:
+        baselines.changed.update(output.get('sqlalch_plans', {}))
+    impact.merge(node.config.sqlalch_impact, output.get('sqlalch_impact', {}))
+    if trace.current is not None:
+        trace.current.events.extend(output.get('sqlalch_trace', []))
+
+
+def pytest_collection_modifyitems(config, items):
+    names = [name for value in config.getoption('--db-tables')
+             for name in value.split(',') if name]
+    if not names or getattr(config, 'cache', None) is None:
+        return
+    kept, deselected = impact.select(
+        items, config.cache.get(impact.CACHE_KEY, {}),
+        impact.resolve(names, Base),
+    )
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = kept
+
+
+def pytest_generate_tests(metafunc):
+    if matrix.results is not None and 'driver' in metafunc.fixturenames:
+        metafunc.parametrize('driver', matrix.results.drivers, indirect=True,
+                             scope='session')
+
+
+def pytest_runtest_logreport(report):
+    props = dict(getattr(report, 'user_properties', ()))
+    if matrix.results is not None and 'db_driver' in props:
+        matrix.results.add(props['db_test'], props['db_driver'],
+                           report.outcome, props['db_time'])
+
+
+def pytest_terminal_summary(terminalreporter):
+    if matrix.results is not None and matrix.results.tests:
+        terminalreporter.write_sep('=', 'database driver matrix')
+        for line in matrix.results.lines():
+            terminalreporter.write_line(line)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    impact.start()
+    matrix.start()
+    yield
+    touched = impact.stop()
+    if touched is not None:
+        impact.merge(item.config.sqlalch_impact, {item.nodeid: touched})
+
+
+def trace_phase(item, phase):
+    start = trace.now()
+    outcome = yield
+    if trace.current is not None:
+        trace.current.complete(phase, trace.PYTEST_TID, start,
+                               nodeid=item.nodeid)
+    return outcome
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_setup(item):
+    yield from trace_phase(item, 'setup')
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = get_marker(item, 'memory_limit')
+    ceiling = bulk.MemoryCeiling(**marker.kwargs) if marker is not None else None
+    if ceiling is not None:
+        ceiling.start()
+    outcome = yield from trace_phase(item, 'call')
+    problems = ceiling.check() if ceiling is not None else []
+    impact.passed = outcome.excinfo is None and not problems
+    if problems and outcome.excinfo is None:
+        pytest.fail('memory limit exceeded: %s' % '; '.join(problems),
+                    pytrace=False)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item):
+    yield from trace_phase(item, 'teardown')
+
+
+def worker_id(config):
+    """Return xdist worker id such as 'gw0', or 'main' if not a worker."""
+    workerinput = getattr(config, 'workerinput',
+                          getattr(config, 'slaveinput', {}))
+    return workerinput.get('workerid', 'main')
+
+
+def migrations_path(config):
+    """Return path of alembic.ini from `db_migrations`, or None."""
+    path = config.getini('db_migrations')
+    return str(config.rootdir.join(path)) if path else None
+
+
+def worker_output(config):
+    """Return dict sent back to the xdist controller, or None if not a worker."""
+    return getattr(config, 'workeroutput', getattr(config, 'slaveoutput', None))
+
+
+def node_output(node):
+    """Return dict sent back from an xdist worker node."""
+    return getattr(node, 'workeroutput', getattr(node, 'slaveoutput', {}))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    report = outcome.get_result()
+    driver = getattr(item, 'callspec', None) and item.callspec.params.get('driver')
+    if driver is not None:
+        report.user_properties = list(getattr(report, 'user_properties', [])) + [
+            ('db_driver', driver),
+            ('db_test', matrix.base_id(item, driver)),
+            ('db_time', matrix.elapsed),
+        ]
+        matrix.start()
+    section = locks.report_section(call.excinfo) \
+        if report.when == 'call' and report.failed else None
+    if section is not None:
+        report.sections.append(section)
+
+
+def get_marker(node, name):
+    """Return closest marker `name` for node (on any pytest version)."""
+    if hasattr(node, 'get_closest_marker'):
+        return node.get_closest_marker(name)
+    return node.get_marker(name)
+
+
 def put(*args, **kwargs):
     if 'file' not in kwargs:
         kwargs['file'] = sys.stderr
@@ -49,15 +287,76 @@ def debug_tx(sess, trans):
 
 
 @pytest.fixture(scope='session')
-def engine():
-    return make_engine(echo=False)
+def driver(request):
+    """Fixture naming the driver for the `engine` (see `--db-drivers`)."""
+    return getattr(request, 'param', None)
 
 
 @pytest.fixture(scope='session')
-def db(engine):
+def engine(request, driver):
+    """
+    Fixture providing the engine for the test database.
+
+    With the `db_migrations` ini option, the test database is a clone of
+    a template migrated to the current head, dropped in the background at
+    teardown.
+    """
+    config = request.config
+    path = migrations_path(config)
+    url = make_url(CONNECT_URL)
+    clone_url = None
+    # `python -m test.watch` keeps engines alive across runs
+    warm = getattr(config, 'sqlalch_warm', None)
+    if warm is not None and driver in warm.engines:
+        engine = warm.engines[driver]
+    else:
+        if path is not None:
+            if driver == 'sqlite':
+                pytest.skip('db_migrations needs PostgreSQL')
+            name = migrations.clone_name(url, worker_id(config))
+            reaper.wait(reaper.key(migrations.with_database(url, name)))
+            clone_url = migrations.setup(url, path, name)
+        if driver is None:
+            engine = make_engine(echo=False, url=clone_url or url)
+        else:
+            try:
+                engine = matrix.make_engine(driver, clone_url or url,
+                                            worker_id(config))
+            except ImportError as e:
+                pytest.skip('driver %s is not available: %s' % (driver, e))
+        if warm is not None:
+            warm.engines[driver], clone_url = engine, None
+    if path is not None:
+        differences = migrations.drift(engine, Base.metadata)
+        if differences:
+            pytest.fail('migrations and Base.metadata differ:\n%s' % (
+                pprint.pformat(differences)), pytrace=False)
+    locks.install(engine)
+    plans.install(engine)
+    if trace.current is not None:
+        trace.install(engine)
+    impact.install(engine)
+    if matrix.results is not None:
+        matrix.install(engine)
+    yield engine
+    if clone_url is not None:
+        reaper.defer(reaper.key(clone_url), migrations.teardown, url, engine)
+
+
+@pytest.fixture(scope='session')
+def db(request, engine):
     """
     Fixture that does one-time setup and teardown of db tables.
 
+    Tables are dropped in the background at teardown, while the rest of
+    the session finishes, and the run waits for that before it exits;
+    setup drops any tables a previous run didn't get to drop.
+
+    With `--db-keep-schema`, tables are left in place at teardown and
+    are only emptied at setup unless `Base.metadata` changed. With the
+    `db_migrations` ini option, the `engine` fixture's database already
+    has the schema and is dropped as a whole.
+
     Transation management and rolling back after each test is provided
     via the `session` fixture.
 
@@ -68,8 +367,29 @@ def db(engine):
     is automatically run before every test function).
     """
 
-    with engine.connect() as conn:
-        Base.metadata.create_all(conn)
+    config = request.config
+    warm = getattr(config, 'sqlalch_warm', None)
+    migrated = migrations_path(config) is not None
+    keep_schema = config.getoption('--db-keep-schema')
+    reaper.wait(reaper.key(engine.url))
+    if migrated:
+        # a migrated clone is only reused (with old seed data) in watch mode
+        if warm is not None:
+            with engine.connect() as conn:
+                schema.empty(conn, Base.metadata)
+    elif keep_schema:
+        cache = getattr(config, 'cache', None)
+        key = '%s/%s' % (schema.CACHE_KEY, engine.url.database)
+        with engine.connect() as conn:
+            fingerprint = schema.prepare(
+                conn, Base.metadata,
+                cache.get(key, None) if cache is not None else None,
+            )
+        if cache is not None:
+            cache.set(key, fingerprint)
+    else:
+        with engine.connect() as conn:
+            schema.prepare(conn, Base.metadata)
     try:
         with engine.connect() as conn:
             kw = dict(
@@ -109,8 +429,12 @@ def db(engine):
                 original_created_by=obj.created_by,
             )
     finally:
-        Base.metadata.drop_all(engine)
-        engine.dispose()
+        if warm is None:
+            if keep_schema or migrated:
+                engine.dispose()
+            else:
+                reaper.defer(reaper.key(engine.url), schema.drop, engine,
+                             Base.metadata)
 
 
 @pytest.fixture
@@ -158,15 +482,26 @@ def obj(db):
 
 
 @pytest.fixture(scope='function', autouse=True)
-def session(db):
+def session(request, db):
     conn = db.connection
     s = db.session
+    dialect = get_marker(request.node, 'db_dialect')
+    if dialect is not None and db.engine.dialect.name not in dialect.args:
+        pytest.skip('needs %s' % ' or '.join(dialect.args))
+    timeouts = locks.resolve(request.config, get_marker(request.node, 'db_timeout'))
+    baselines = getattr(request.config, 'sqlalch_plans', None)
+    if baselines is not None and get_marker(request.node, 'db_explain') \
+            and db.engine.dialect.name == 'postgresql':
+        plans.start()
 
     # with conn.begin():
     #     assert s.query(Thing).count() == 1
     #     assert s.query(Thing).first().name == DEFAULT_NAME
 
     tx_base = conn.begin()
+    locks.set_local(conn, timeouts)
+    locks.current.update(timeouts)
+    locks.watch(db.engine, timeouts)
     tx_sub = conn.begin_nested()
     tx_session = s.begin_nested()
 
@@ -181,6 +516,11 @@ def session(db):
         if tx.nested and not tx._parent.nested:
             tx_session = s.begin_nested()
 
+    interceptor = None
+    if request.config.getini('db_intercept_commit') \
+            or get_marker(request.node, 'db_intercept_commit'):
+        interceptor = commits.CommitInterceptor(s, conn)
+
     yield s
 
     # print('\ninfo:', pprint.pformat({
@@ -194,7 +534,76 @@ def session(db):
     #     's.is_active': s.is_active,
     # }), file=sys.stderr)
 
-    if not tx_session_ended:
+    locks.unwatch()
+
+    # explain recorded statements while the test's state is still visible
+    problems, missing = [], []
+    if plans.recorded is not None:
+        problems, missing = baselines.check(conn, plans.stop())
+
+    if interceptor is not None:
+        interceptor.remove()
+
+    # stop restarting savepoints first, or the teardown rollback would
+    # leave a nested transaction behind for the next test
+    event.remove(s, 'after_transaction_end', after_transaction_end)
+
+    # a commit in the test ends `tx_session`, but the listener will have
+    # begun another nested transaction that still needs rolling back
+    while s.transaction is not None and s.transaction.nested:
         s.rollback()
 
     tx_base.rollback()
+    locks.current.update(dict.fromkeys(locks.TIMEOUTS))
+
+    if missing:
+        warnings.warn('no query plan baselines in %s, run with '
+                      '--db-explain=update to create them:\n    %s' % (
+                          baselines.path, '\n    '.join(missing)))
+    if problems:
+        msg = 'query plan regressions:\n' + '\n'.join(problems)
+        if baselines.mode == 'fail':
+            pytest.fail(msg, pytrace=False)
+        warnings.warn(msg)
+
+
+@pytest.fixture
+def connections(request, db, session):
+    """
+    Fixture providing N extra connections, each in a rolled-back transaction.
+
+    The number of connections and whether they share a snapshot exported
+    from `db.connection` are set with the `db_connections` marker.
+
+    The connections only see the state seeded by the `db` fixture, not
+    rows the test itself wrote on `db.connection` (e.g. `bulk_things`),
+    with or without a snapshot: those are never committed, and exported
+    snapshots don't include them.
+    """
+    if 'bulk_things' in request.fixturenames:
+        warnings.warn('rows of bulk_things are not visible to the '
+                      'connections/session_pool fixtures')
+    n, use_snapshot = concurrency.resolve(get_marker(request.node, 'db_connections'))
+    snapshot = concurrency.export_snapshot(db.connection) if use_snapshot else None
+    opened = concurrency.open_connections(db.engine, n, snapshot)
+    yield [conn for conn, _ in opened]
+    concurrency.close_connections(opened)
+
+
+@pytest.fixture
+def bulk_things(request, db, session):
+    """
+    Fixture inserting many generated rows into `thing` within the test's
+    transaction; returns the number of rows (see the `db_rows` marker).
+    """
+    marker = get_marker(request.node, 'db_rows')
+    rows = marker.args[0] if marker is not None else bulk.DEFAULT_ROWS
+    return bulk.generate(db.connection, Thing.__table__, rows)
+
+
+@pytest.fixture
+def session_pool(connections):
+    """Fixture providing a thread pool pre-bound to a session per connection."""
+    pool = concurrency.SessionPool(connections)
+    yield pool
+    pool.shutdown()
@@ -0,0 +1,171 @@
+"""
+Per-test record of the tables each test reads and writes.
+
+Table names are parsed from the SQL sent to the database while a test
+runs (setup, call and teardown). The map is kept in the pytest cache and
+used by `--db-tables` to run only the tests that touched the given tables,
+plus any test that has no record yet.
+
+Only tests whose call phase passed are recorded, since a test that failed
+may not have got to all of its SQL; a new record is merged with the
+previous one rather than replacing it.
+"""
+import re
+
+from sqlalchemy import event
+
+CACHE_KEY = 'sqlalch/table_impact'
+
+NAME = r'(?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?'
+# each of these starts a list of tables, e.g. `FROM a, b AS x JOIN c`
+CLAUSE_RE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE|USING)\s+', re.IGNORECASE)
+ITEM_RE = re.compile(r'(%s)|\(' % NAME)
+ALIAS_RE = re.compile(r'\s+(?:AS\s+)?("[^"]+"|\w+)', re.IGNORECASE)
+COMMA_RE = re.compile(r'\s*,\s*')
+WRITE_RE = re.compile(
+    r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(%s)' % NAME,
+    re.IGNORECASE,
+)
+# words that end a table list rather than alias its last table
+KEYWORDS = frozenset("""
+    CROSS DEFAULT EXCEPT FETCH FOR FROM FULL GROUP HAVING INNER INTERSECT
+    JOIN LEFT LIMIT NATURAL OFFSET ON ORDER OUTER RETURNING RIGHT SELECT SET
+    UNION USING VALUES WHERE WINDOW
+""".split())
+
+# {'read': set(), 'write': set()} for the running test, or None
+current = None
+
+# whether the call phase of the running test passed, see `stop`
+passed = False
+
+
+def unquote(name):
+    return name.replace('"', '').split('.')[-1]
+
+
+def skip_parens(statement, pos):
+    """Return position after the parenthesis that closes the one at `pos`."""
+    depth = 0
+    for pos in range(pos, len(statement)):
+        if statement[pos] == '(':
+            depth += 1
+        elif statement[pos] == ')':
+            depth -= 1
+            if not depth:
+                return pos + 1
+    return len(statement)
+
+
+def table_list(statement, pos):
+    """
+    Yield names of the comma-separated tables starting at `pos`.
+
+    Subqueries in the list are skipped; their own FROM clauses are found
+    separately.
+    """
+    while True:
+        match = ITEM_RE.match(statement, pos)
+        if not match:
+            return
+        if match.group(1):
+            yield match.group(1)
+            pos = match.end()
+        else:
+            pos = skip_parens(statement, match.start())
+        alias = ALIAS_RE.match(statement, pos)
+        if alias and alias.group(1).upper() not in KEYWORDS:
+            pos = alias.end()
+        comma = COMMA_RE.match(statement, pos)
+        if not comma:
+            return
+        pos = comma.end()
+
+
+def tables(statement):
+    """Return (read, written) table names for SQL `statement`."""
+    written = set()
+    match = WRITE_RE.match(statement)
+    if match:
+        written.add(unquote(match.group(1)))
+    read = {unquote(name)
+            for clause in CLAUSE_RE.finditer(statement)
+            for name in table_list(statement, clause.end())} - written
+    return read, written
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current is not None:
+        read, written = tables(statement)
+        current['read'] |= read
+        current['write'] |= written
+
+
+def install(engine):
+    if not event.contains(engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def uninstall(engine):
+    if event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def start():
+    global current, passed
+    current = {'read': set(), 'write': set()}
+    passed = False
+
+
+def stop():
+    """Return the running test's record, or None if its call didn't pass."""
+    global current
+    touched, current = current, None
+    if not passed:
+        return None
+    return {key: sorted(names) for key, names in touched.items()}
+
+
+def merge(recorded, new):
+    """Merge {nodeid: record} `new` into `recorded`, keeping older tables."""
+    for nodeid, touched in new.items():
+        previous = recorded.get(nodeid, {})
+        recorded[nodeid] = {
+            key: sorted(set(previous.get(key, [])) | set(names))
+            for key, names in touched.items()
+        }
+    return recorded
+
+
+def model_tables(base):
+    """Return {mapped class name: table name} for classes derived from `base`."""
+    found = {}
+    classes = list(base.__subclasses__())
+    while classes:
+        cls = classes.pop()
+        classes.extend(cls.__subclasses__())
+        table = getattr(cls, '__table__', None)
+        if table is not None:
+            found[cls.__name__] = table.name
+    return found
+
+
+def resolve(names, base):
+    """Map table or model class names given on the command line to tables."""
+    models = model_tables(base)
+    return {models.get(name, name) for name in names}
+
+
+def select(items, impact, selected):
+    """Return (kept, deselected) items given `impact` map and table names."""
+    kept, deselected = [], []
+    for item in items:
+        touched = impact.get(item.nodeid)
+        if touched is None \
+                or selected & set(touched['read'] + touched['write']):
+            kept.append(item)
+        else:
+            deselected.append(item)
+    return kept, deselected
@@ -0,0 +1,216 @@
+"""
+Per-test lock_timeout/statement_timeout enforcement and lock diagnostics.
+
+A test that opens a second connection can block forever on row locks held
+by the shared `db.connection` transaction. Timeouts make such a test fail
+quickly, and `snapshot` reports who was holding and waiting for what.
+
+By the time the test sees the timeout error the wait has been cancelled
+and its locks are gone, so while a test runs a `Watchdog` thread polls
+for blocked backends and keeps a snapshot taken while the wait was live.
+"""
+import logging
+import re
+import threading
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import NullPool
+
+log = logging.getLogger(__name__)
+
+TIMEOUTS = ('lock_timeout', 'statement_timeout')
+
+# SQLSTATE codes for "canceling statement due to lock/statement timeout"
+TIMEOUT_PGCODES = ('55P03', '57014')
+
+VALUE_RE = re.compile(r'^(\d+)\s*(us|ms|s|min|h|d)?$')
+UNITS = {'us': 1e-6, 'ms': 1e-3, 's': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+SNAPSHOT_SQL = """
+SELECT a.pid, a.state, a.wait_event_type, a.wait_event,
+       pg_blocking_pids(a.pid) AS blocked_by,
+       l.locktype, l.relation::regclass AS relation, l.mode, l.granted,
+       a.query
+FROM pg_stat_activity a
+LEFT JOIN pg_locks l ON l.pid = a.pid
+WHERE a.datname = current_database() AND a.pid <> pg_backend_pid()
+ORDER BY a.pid, l.granted, l.locktype
+"""
+
+# backends waiting for a lock, or running for longer than :age seconds
+# (a NULL :age only matches waiting backends)
+BLOCKED_SQL = """
+SELECT count(*)
+FROM pg_stat_activity
+WHERE datname = current_database() AND pid <> pg_backend_pid()
+  AND state = 'active'
+  AND (cardinality(pg_blocking_pids(pid)) > 0
+       OR query_start < clock_timestamp()
+                        - make_interval(secs => CAST(:age AS float)))
+"""
+
+# polling interval of the watchdog, as a fraction of the shortest timeout
+POLL_FRACTION = 0.25
+
+# timeouts in effect for the currently running test; applied to every
+# connection checked out of the pool while the test runs
+current = dict.fromkeys(TIMEOUTS)
+
+# Watchdog of the currently running test, or None
+watchdog = None
+
+
+def check_value(name, value):
+    if value is None or value == '':
+        return None
+    value = str(value).strip()
+    if not VALUE_RE.match(value):
+        raise ValueError('invalid %s value: %r' % (name, value))
+    return value
+
+
+def seconds(value):
+    """Return timeout `value` (in PostgreSQL syntax) in seconds, or None."""
+    if value is None:
+        return None
+    number, unit = VALUE_RE.match(value).groups()
+    return int(number) * UNITS[unit or 'ms'] or None
+
+
+def resolve(config, marker=None):
+    """Return timeouts for a test from its `db_timeout` marker and ini options."""
+    kw = marker.kwargs if marker is not None else {}
+    return {
+        name: check_value(name, kw.get(name.split('_')[0],
+                                       config.getini('db_' + name)))
+        for name in TIMEOUTS
+    }
+
+
+def set_local(conn, timeouts):
+    """Apply timeouts to the current transaction of `conn` (SET LOCAL)."""
+    if conn.engine.dialect.name != 'postgresql':
+        return
+    for name, value in timeouts.items():
+        if value is not None:
+            conn.execute(text("SET LOCAL %s = '%s'" % (name, value)))
+
+
+def checkout(dbapi_conn, connection_record, connection_proxy):
+    cursor = dbapi_conn.cursor()
+    try:
+        for name in TIMEOUTS:
+            value = current[name]
+            cursor.execute("SET %s = '%s'" % (name, value or 0))
+    finally:
+        cursor.close()
+
+
+def install(engine):
+    """Apply the running test's timeouts to newly checked out connections."""
+    if engine.dialect.name == 'postgresql' \
+            and not event.contains(engine, 'checkout', checkout):
+        event.listen(engine, 'checkout', checkout)
+
+
+def uninstall(engine):
+    if event.contains(engine, 'checkout', checkout):
+        event.remove(engine, 'checkout', checkout)
+
+
+def is_timeout(excinfo):
+    if excinfo is None or not isinstance(excinfo.value, DBAPIError):
+        return False
+    orig = excinfo.value.orig
+    if getattr(orig, 'pgcode', None) in TIMEOUT_PGCODES:
+        return True
+    msg = str(orig)
+    return 'lock timeout' in msg or 'statement timeout' in msg
+
+
+def report_section(excinfo):
+    """
+    Return (title, text) of the report section for a test that failed with
+    `excinfo`, or None if it didn't fail with a timeout under a watchdog.
+    """
+    if watchdog is None or not is_timeout(excinfo):
+        return None
+    return ('pg_locks before timeout',
+            watchdog.snapshot or 'no blocked backends seen before timeout')
+
+
+def snapshot(conn):
+    """Describe pg_stat_activity and pg_locks for other backends as text."""
+    lines = []
+    rows = conn.execute(text(SNAPSHOT_SQL)).fetchall()
+    last_pid = None
+    for row in rows:
+        if row.pid != last_pid:
+            last_pid = row.pid
+            lines.append('pid %s [%s] waiting=%s:%s blocked_by=%s' % (
+                row.pid, row.state, row.wait_event_type, row.wait_event,
+                list(row.blocked_by or []),
+            ))
+            lines.append('    query: %s' % ' '.join((row.query or '').split()))
+        if row.locktype is not None:
+            lines.append('    %s %s %s %s' % (
+                'held' if row.granted else 'WAITING',
+                row.mode, row.locktype, row.relation or '',
+            ))
+    return '\n'.join(lines) or 'no other backends in current database'
+
+
+class Watchdog:
+    """
+    Poll for blocked backends while a test runs; keep the last snapshot.
+
+    Polls several times per shortest timeout, so the last snapshot was
+    taken shortly before the timeout cancelled the wait. Backends running
+    for more than half the statement timeout count as blocked too.
+
+    Polls on a connection of its own engine, so that none of the listeners
+    on the test's engine (plans, impact, trace, matrix) see its queries.
+    """
+
+    def __init__(self, engine, timeouts):
+        self.engine = create_engine(engine.url, poolclass=NullPool)
+        self.snapshot = None
+        limits = {name: seconds(value) for name, value in timeouts.items()}
+        statement = limits['statement_timeout']
+        self.age = statement / 2 if statement else None
+        shortest = min(limit for limit in limits.values() if limit)
+        self.interval = min(max(shortest * POLL_FRACTION, 0.01), 1.0)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='pg_locks watchdog')
+
+    def run(self):
+        try:
+            with self.engine.connect() as conn:
+                while not self.stopped.wait(self.interval):
+                    if conn.execute(text(BLOCKED_SQL), age=self.age).scalar():
+                        self.snapshot = snapshot(conn)
+        except DBAPIError:
+            log.exception('pg_locks watchdog failed')
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.engine.dispose()
+
+
+def watch(engine, timeouts):
+    """Start watching for blocked backends for the running test."""
+    global watchdog
+    if engine.dialect.name == 'postgresql' and any(
+            seconds(value) for value in timeouts.values()):
+        watchdog = Watchdog(engine, timeouts)
+        watchdog.thread.start()
+
+
+def unwatch():
+    global watchdog
+    if watchdog is not None:
+        watchdog.stop()
+        watchdog = None
@@ -0,0 +1,163 @@
+"""
+Running the suite against several database drivers and backends.
+
+With `--db-drivers=psycopg2,psycopg,pg8000,sqlite` the session-scoped
+`engine` fixture, and with it every test, is parametrized by driver.
+Drivers whose DBAPI module (or SQLAlchemy dialect) isn't available are
+skipped. The time spent in the database is measured per test, and a
+side-by-side table of outcome and DB time per driver is shown at the end
+of the run.
+"""
+import copy
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import NoSuchModuleError
+
+DRIVERS = {
+    'psycopg2': 'postgresql+psycopg2',
+    'psycopg': 'postgresql+psycopg',
+    'pg8000': 'postgresql+pg8000',
+    'sqlite': 'sqlite',
+}
+# a test's outcome is the worst of its setup, call and teardown outcomes
+OUTCOMES = ('passed', 'skipped', 'failed')
+
+# seconds spent executing statements during the running test phase; only
+# statements of the thread running the test count, not those of its
+# session pool workers, so only that thread ever updates it
+elapsed = 0.0
+
+# id of the thread running the test, see `start`
+thread = None
+
+# Results of this run, or None when not running a driver matrix
+results = None
+
+
+def parse(values):
+    drivers = [name for value in values for name in value.split(',') if name]
+    unknown = sorted(set(drivers) - set(DRIVERS))
+    if unknown:
+        raise ValueError('unknown drivers: %s (choose from %s)' % (
+            ', '.join(unknown), ', '.join(sorted(DRIVERS))))
+    return drivers
+
+
+def driver_url(url, driver, worker):
+    if driver == 'sqlite':
+        return 'sqlite:///%s' % os.path.join(
+            tempfile.gettempdir(), '%s_%s.sqlite' % (url.database, worker))
+    if hasattr(url, 'set'):
+        return url.set(drivername=DRIVERS[driver])
+    url = copy.copy(url)
+    url.drivername = DRIVERS[driver]
+    return url
+
+
+def sqlite_savepoints(engine):
+    """
+    Let pysqlite support SAVEPOINT, as the `session` fixture needs.
+
+    pysqlite emits BEGIN itself, too late and not for every statement;
+    turn that off and emit BEGIN when SQLAlchemy starts a transaction.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.execute('BEGIN')
+
+
+def make_engine(driver, url, worker):
+    """Return engine for `driver`, or raise ImportError if not available."""
+    try:
+        engine = create_engine(driver_url(url, driver, worker))
+    except NoSuchModuleError as e:
+        raise ImportError(str(e))
+    if driver == 'sqlite':
+        sqlite_savepoints(engine)
+    return engine
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if threading.get_ident() == thread:
+        conn.info.setdefault('sqlalch_matrix', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    global elapsed
+    starts = conn.info.get('sqlalch_matrix')
+    if threading.get_ident() == thread and starts:
+        elapsed += time.perf_counter() - starts.pop()
+
+
+LISTENERS = {
+    'before_cursor_execute': before_cursor_execute,
+    'after_cursor_execute': after_cursor_execute,
+}
+
+
+def install(engine):
+    for name, listener in LISTENERS.items():
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+def uninstall(engine):
+    for name, listener in LISTENERS.items():
+        if event.contains(engine, name, listener):
+            event.remove(engine, name, listener)
+
+
+def start():
+    global elapsed, thread
+    elapsed = 0.0
+    thread = threading.get_ident()
+
+
+def base_id(item, driver):
+    """Return node id of `item` without the driver parameter."""
+    ids = item.callspec.id.split('-')
+    ids.remove(driver)
+    name = item.nodeid.split('[', 1)[0]
+    return '%s[%s]' % (name, '-'.join(ids)) if ids else name
+
+
+class Results:
+    """Outcome and DB time per test and driver."""
+
+    def __init__(self, drivers):
+        self.drivers = drivers
+        self.tests = {}
+
+    def add(self, test, driver, outcome, db_time):
+        previous, total = self.tests.setdefault(test, {}).get(
+            driver, (outcome, 0.0))
+        worst = max(previous, outcome, key=OUTCOMES.index)
+        self.tests[test][driver] = (worst, total + db_time)
+
+    def lines(self):
+        """Yield lines of the side-by-side table, with totals."""
+        width = max([len(test) for test in self.tests] + [len('total')])
+        yield '%-*s  %s' % (width, 'test', '  '.join(
+            '%-18s' % driver for driver in self.drivers))
+        totals = dict.fromkeys(self.drivers, 0.0)
+        for test in sorted(self.tests):
+            cells = []
+            for driver in self.drivers:
+                outcome, db_time = self.tests[test].get(driver, ('-', 0.0))
+                totals[driver] += db_time
+                cells.append('%-7s %8.1fms  ' % (outcome, db_time * 1000))
+            yield '%-*s  %s' % (width, test, ''.join(cells))
+        yield '%-*s  %s' % (width, 'total', ''.join(
+            '%-7s %8.1fms  ' % ('', totals[driver] * 1000)
+            for driver in self.drivers))
@@ -0,0 +1,140 @@
+"""
+Migration-driven schema source for the test database.
+
+When the `db_migrations` ini option names an alembic.ini, the schema comes
+from running the migrations instead of `Base.metadata.create_all`. The
+migrations are applied once per head revision to a template database,
+and every run (and every xdist worker) gets its own database cloned from
+that template with `CREATE DATABASE ... TEMPLATE`, which is much faster
+than replaying the migrations. Each clone is compared with `Base.metadata`
+so that models and migrations can't silently drift apart.
+
+Requires alembic, which is only imported when migrations are configured.
+"""
+import copy
+import os
+
+from sqlalchemy import create_engine, text
+
+from . import reaper
+
+TEMPLATE_FORMAT = '%s_tpl_%s'
+CLONE_FORMAT = '%s_test_%s_%d'
+
+
+def with_database(url, database):
+    if hasattr(url, 'set'):
+        return url.set(database=database)
+    url = copy.copy(url)
+    url.database = database
+    return url
+
+
+def admin_engine(url):
+    """Return engine on the base database for CREATE/DROP DATABASE."""
+    return create_engine(url, isolation_level='AUTOCOMMIT')
+
+
+def alembic_config(path, url):
+    from alembic.config import Config
+    cfg = Config(path)
+    cfg.set_main_option('sqlalchemy.url', str(url))
+    return cfg
+
+
+def head_revision(cfg):
+    from alembic.script import ScriptDirectory
+    return ScriptDirectory.from_config(cfg).get_current_head()
+
+
+def database_exists(conn, name):
+    return bool(conn.execute(
+        text('SELECT 1 FROM pg_database WHERE datname = :name'), name=name,
+    ).scalar())
+
+
+def upgrade(path, url):
+    from alembic import command
+    engine = create_engine(url)
+    try:
+        with engine.connect() as conn:
+            cfg = alembic_config(path, url)
+            cfg.attributes['connection'] = conn
+            command.upgrade(cfg, 'head')
+    finally:
+        engine.dispose()
+
+
+def ensure_template(admin, path, url):
+    """Return name of the template database migrated to the current head."""
+    head = head_revision(alembic_config(path, url))
+    name = TEMPLATE_FORMAT % (url.database, (head or 'base')[:12])
+    building = name + '_building'
+    with admin.connect() as conn:
+        # xdist workers starting together must not build the template twice
+        conn.execute(text('SELECT pg_advisory_lock(hashtext(:name))'), name=name)
+        try:
+            if not database_exists(conn, name):
+                conn.execute(text('DROP DATABASE IF EXISTS "%s"' % building))
+                conn.execute(text('CREATE DATABASE "%s"' % building))
+                upgrade(path, with_database(url, building))
+                conn.execute(text(
+                    'ALTER DATABASE "%s" RENAME TO "%s"' % (building, name)))
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(hashtext(:name))'),
+                         name=name)
+    return name
+
+
+def clone(admin, template, name):
+    with admin.connect() as conn:
+        conn.execute(text('DROP DATABASE IF EXISTS "%s"' % name))
+        conn.execute(text('CREATE DATABASE "%s" TEMPLATE "%s"' % (name, template)))
+        # tells `reaper.reap` of other runs whether this clone is orphaned
+        conn.execute(text("COMMENT ON DATABASE \"%s\" IS '%s'" % (
+            name, reaper.owner().replace("'", "''"))))
+
+
+def drop(admin, name):
+    with admin.connect() as conn:
+        conn.execute(text('DROP DATABASE IF EXISTS "%s"' % name))
+
+
+def drift(engine, metadata):
+    """Return differences between the database of `engine` and `metadata`."""
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    with engine.connect() as conn:
+        return compare_metadata(MigrationContext.configure(conn), metadata)
+
+
+def clone_prefix(url):
+    """Return prefix of the names of all clones of the database of `url`."""
+    return '%s_test_' % url.database
+
+
+def clone_name(url, worker):
+    return CLONE_FORMAT % (url.database, worker, os.getpid())
+
+
+def setup(url, path, name):
+    """
+    Clone a database migrated to head as `name`; return its URL.
+    """
+    admin = admin_engine(url)
+    try:
+        template = ensure_template(admin, path, url)
+        clone(admin, template, name)
+    finally:
+        admin.dispose()
+    return with_database(url, name)
+
+
+def teardown(url, engine):
+    """Dispose `engine` and drop its cloned database."""
+    engine.dispose()
+    admin = admin_engine(url)
+    try:
+        drop(admin, engine.url.database)
+    finally:
+        admin.dispose()
@@ -35,6 +35,6 @@ class Thing(Base):
     __repr__ = __str__
 
 
-def make_engine(echo=True):
-    engine = create_engine(CONNECT_URL, echo=echo)
+def make_engine(echo=True, url=CONNECT_URL):
+    engine = create_engine(url, echo=echo)
     return engine
@@ -0,0 +1,149 @@
+"""
+Query-plan regression checks using EXPLAIN (FORMAT JSON).
+
+While a test marked with `db_explain` runs, every distinct SELECT and
+UPDATE sent to the database is recorded. Before the test's transaction is
+rolled back, each one is explained on the test's connection and its plan
+shape and estimated cost are compared to the stored baseline.
+
+Baselines are only written by `--db-explain=update`, which has to be run
+first. In warn and fail mode, statements without a baseline (all of them
+when the baselines file doesn't exist yet) are never failed on; they are
+returned separately so that the run can warn about them.
+"""
+import json
+import os
+
+from sqlalchemy import event
+
+MODES = ('warn', 'fail', 'update')
+EXPLAINED = ('SELECT', 'UPDATE')
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Heap Scan')
+
+# statement -> parameters for the running test, or None when not recording
+recorded = None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if recorded is None or executemany:
+        return
+    if statement.lstrip().upper().startswith(EXPLAINED):
+        recorded.setdefault(normalize(statement), parameters)
+
+
+def install(engine):
+    if not event.contains(engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def uninstall(engine):
+    if event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def start():
+    global recorded
+    recorded = {}
+
+
+def stop():
+    global recorded
+    statements, recorded = recorded, None
+    return statements or {}
+
+
+def normalize(statement):
+    return ' '.join(statement.split())
+
+
+def shape(node):
+    """Return plan tree without the estimates, for comparing plans."""
+    return {
+        'node': node['Node Type'],
+        'relation': node.get('Relation Name'),
+        'index': node.get('Index Name'),
+        'children': [shape(child) for child in node.get('Plans', [])],
+    }
+
+
+def scans(tree, found=None):
+    """Return {relation: set of scan node types} for a plan shape."""
+    found = {} if found is None else found
+    if tree['relation'] is not None:
+        found.setdefault(tree['relation'], set()).add(tree['node'])
+    for child in tree['children']:
+        scans(child, found)
+    return found
+
+
+def explain(conn, statement, parameters):
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        result = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan = result[0]['Plan']
+    return {'shape': shape(plan), 'cost': plan['Total Cost']}
+
+
+def compare(baseline, plan, cost_factor):
+    """Return list of problems with `plan` relative to `baseline`."""
+    problems = []
+    before, after = scans(baseline['shape']), scans(plan['shape'])
+    for relation, nodes in sorted(after.items()):
+        if 'Seq Scan' in nodes and 'Seq Scan' not in before.get(relation, ()) \
+                and before.get(relation, set()) & set(INDEX_SCANS):
+            problems.append('%s: index scan became seq scan' % relation)
+    if plan['cost'] > baseline['cost'] * cost_factor:
+        problems.append('cost %.2f exceeds baseline %.2f * %s' % (
+            plan['cost'], baseline['cost'], cost_factor))
+    return problems
+
+
+class Baselines:
+    """Plan baselines stored as JSON in the repo, keyed by statement."""
+
+    def __init__(self, path, mode, cost_factor):
+        self.path = path
+        self.mode = mode
+        self.cost_factor = cost_factor
+        self.plans = {}
+        self.changed = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.plans = json.load(f)
+
+    def check(self, conn, statements):
+        """
+        Explain `statements` on `conn`; return list of problem strings and
+        list of statements that have no baseline to compare with.
+        """
+        problems, missing = [], []
+        for statement, parameters in sorted(statements.items()):
+            try:
+                plan = explain(conn, statement, parameters)
+            except conn.engine.dialect.dbapi.Error:
+                break  # transaction already failed; nothing more to explain
+            baseline = self.plans.get(statement)
+            if self.mode == 'update':
+                self.changed[statement] = plan
+            elif baseline is None:
+                missing.append(statement)
+            else:
+                problems.extend('%s\n    %s' % (problem, statement)
+                                for problem in compare(baseline, plan,
+                                                       self.cost_factor))
+        return problems, missing
+
+    def save(self, changed=None):
+        if self.mode != 'update':
+            return
+        self.plans.update(self.changed if changed is None else changed)
+        with open(self.path, 'w') as f:
+            json.dump(self.plans, f, indent=2, sort_keys=True)
+            f.write('\n')
@@ -0,0 +1,136 @@
+"""
+Background teardown of test databases, and reaping of orphaned ones.
+
+Dropping tables or whole databases at the end of a run doesn't need to
+hold up the rest of the session (the other session fixtures' teardown,
+reporting), so it is done in daemon threads. Anything that is about to
+reuse the same database first waits for its pending teardown, and before
+the process exits `wait_all` waits for all of them, up to `EXIT_TIMEOUT`
+seconds. A run that crashes, or whose teardown takes longer than that,
+leaves an orphaned database behind, which `reap` drops at the start of a
+later run.
+
+A database is only reaped when it is known to be orphaned: it has a
+comment (see `owner`) naming the host, pid and creation time of the run
+that created it, and that run's process is gone from this host, or it
+was created on another host longer than `GRACE_PERIOD` ago. Databases of
+runs that are still starting up, possibly on other hosts sharing the
+server, are left alone.
+"""
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+log = logging.getLogger(__name__)
+
+# seconds to wait at exit for pending teardowns
+EXIT_TIMEOUT = 60
+
+# seconds after which a database created on another host is reaped
+GRACE_PERIOD = 3600
+
+OWNER_FORMAT = 'sqlalch host=%s pid=%d created=%d'
+OWNER_RE = re.compile(r'^sqlalch host=(\S+) pid=(\d+) created=(\d+)$')
+
+lock = threading.Lock()
+
+# key of a database (see `key`) -> teardown threads not yet waited for
+pending = {}
+
+
+def key(url):
+    """Return key identifying the database of `url`, whatever the driver."""
+    return '%s:%s/%s' % (url.host, url.port, url.database)
+
+
+def run(fn, args):
+    try:
+        fn(*args)
+    except Exception:
+        log.exception('background teardown failed')
+
+
+def defer(db_key, fn, *args):
+    """Call `fn(*args)` in a daemon thread; `wait(db_key)` blocks until done."""
+    thread = threading.Thread(target=run, args=(fn, args), daemon=True,
+                              name='teardown %s' % db_key)
+    with lock:
+        pending.setdefault(db_key, []).append(thread)
+    thread.start()
+    return thread
+
+
+def wait(db_key, timeout=None):
+    with lock:
+        threads = pending.pop(db_key, [])
+    for thread in threads:
+        thread.join(timeout)
+
+
+def wait_all(timeout=EXIT_TIMEOUT):
+    """Wait for all pending teardowns, for at most `timeout` seconds."""
+    deadline = time.time() + timeout
+    with lock:
+        threads = [thread for db_threads in pending.values()
+                   for thread in db_threads]
+        pending.clear()
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            log.warning('%s still running at exit', thread.name)
+
+
+def owner():
+    """Return comment identifying this run, for COMMENT ON DATABASE."""
+    return OWNER_FORMAT % (socket.gethostname(), os.getpid(), time.time())
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def orphaned(comment, grace=GRACE_PERIOD):
+    """Return whether the run described by `comment` (see `owner`) is gone."""
+    match = OWNER_RE.match(comment or '')
+    if match is None:
+        return False
+    host, pid, created = match.group(1), int(match.group(2)), int(match.group(3))
+    if host == socket.gethostname():
+        return not pid_exists(pid)
+    return time.time() - created > grace
+
+
+def reap(admin, prefix, grace=GRACE_PERIOD):
+    """
+    Drop orphaned databases whose name starts with `prefix` and that have
+    no connections; return the names of the dropped databases.
+    """
+    dropped = []
+    with admin.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT datname, shobj_description(oid, 'pg_database') "
+            'FROM pg_database d '
+            'WHERE NOT datistemplate AND NOT EXISTS ('
+            '    SELECT 1 FROM pg_stat_activity a WHERE a.datname = d.datname)'
+        )).fetchall()
+        for name, comment in rows:
+            if not name.startswith(prefix) or not orphaned(comment, grace):
+                continue
+            try:
+                conn.execute(text('DROP DATABASE "%s"' % name))
+            except DBAPIError:
+                continue  # someone connected in the meantime
+            dropped.append(name)
+    return dropped
@@ -0,0 +1,58 @@
+"""
+Reuse of created tables between runs when `Base.metadata` hasn't changed.
+
+The fingerprint of a metadata is a hash of the DDL it would emit, so any
+change to tables, columns, constraints or indexes in the models forces
+the tables to be dropped and created again.
+"""
+import hashlib
+
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+CACHE_KEY = 'sqlalch/schema_fingerprint'
+
+
+def fingerprint(metadata, dialect):
+    ddl = []
+    for table in metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=dialect))
+                   for index in sorted(table.indexes, key=lambda i: i.name))
+    return hashlib.sha1('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+
+def tables_exist(conn, metadata):
+    return all(conn.dialect.has_table(conn, table.name, schema=table.schema)
+               for table in metadata.sorted_tables)
+
+
+def empty(conn, metadata):
+    with conn.begin():
+        for table in reversed(metadata.sorted_tables):
+            conn.execute(table.delete())
+
+
+def prepare(conn, metadata, known=None):
+    """
+    Make tables of `metadata` exist and be empty; return their fingerprint.
+
+    When `known` (the fingerprint of the tables created by a previous run)
+    matches and the tables are there, they are only emptied; otherwise they
+    are dropped and created again.
+    """
+    current = fingerprint(metadata, conn.dialect)
+    if current == known and tables_exist(conn, metadata):
+        empty(conn, metadata)
+    else:
+        with conn.begin():
+            metadata.drop_all(conn)
+            metadata.create_all(conn)
+    return current
+
+
+def drop(engine, metadata):
+    """Drop tables of `metadata` and dispose `engine`."""
+    try:
+        metadata.drop_all(engine)
+    finally:
+        engine.dispose()
@@ -0,0 +1,67 @@
+#pylint: disable=missing-docstring
+
+from types import SimpleNamespace
+
+import pytest
+
+from . import impact
+from .models import Base
+
+
+@pytest.mark.parametrize('statement, read, written', [
+    ('SELECT thing.id FROM thing WHERE thing.name = ?', {'thing'}, set()),
+    ('SELECT * FROM a, b AS y, "public"."c" z WHERE a.id = y.id',
+     {'a', 'b', 'c'}, set()),
+    ('SELECT * FROM a JOIN b ON a.id = b.a_id LEFT OUTER JOIN c USING (id)',
+     {'a', 'b', 'c'}, set()),
+    ('SELECT * FROM (SELECT id FROM a) AS s, b ORDER BY 1', {'a', 'b'}, set()),
+    ('SELECT * FROM a WHERE id IN (SELECT a_id FROM b, c)',
+     {'a', 'b', 'c'}, set()),
+    ('INSERT INTO a (id, name) VALUES (?, ?)', set(), {'a'}),
+    ('INSERT INTO a SELECT * FROM b', {'b'}, {'a'}),
+    ('UPDATE a SET name = b.name FROM b, c WHERE a.id = b.id',
+     {'b', 'c'}, {'a'}),
+    ('DELETE FROM a USING b, c AS x WHERE a.id = b.id', {'b', 'c'}, {'a'}),
+])
+def test_tables(statement, read, written):
+    assert impact.tables(statement) == (read, written)
+
+
+def test_resolve_maps_models_and_keeps_table_names():
+    assert impact.resolve(['Thing', 'other'], Base) == {'thing', 'other'}
+
+
+def test_select():
+    items = [SimpleNamespace(nodeid=name) for name in ('new', 'reads', 'writes',
+                                                      'other')]
+    recorded = {
+        'reads': {'read': ['thing'], 'write': []},
+        'writes': {'read': [], 'write': ['thing']},
+        'other': {'read': ['other'], 'write': []},
+    }
+    kept, deselected = impact.select(items, recorded, {'thing'})
+    assert [item.nodeid for item in kept] == ['new', 'reads', 'writes']
+    assert [item.nodeid for item in deselected] == ['other']
+
+
+def test_merge_keeps_previous_tables():
+    recorded = {'t': {'read': ['a'], 'write': ['b']}}
+    impact.merge(recorded, {'t': {'read': ['c'], 'write': []},
+                            'u': {'read': [], 'write': ['d']}})
+    assert recorded == {
+        't': {'read': ['a', 'c'], 'write': ['b']},
+        'u': {'read': [], 'write': ['d']},
+    }
+
+
+def test_stop_only_records_passed_call(monkeypatch):
+    # keep the record of this very test
+    monkeypatch.setattr(impact, 'current', impact.current)
+    monkeypatch.setattr(impact, 'passed', impact.passed)
+    impact.start()
+    impact.current['read'].add('thing')
+    assert impact.stop() is None
+    impact.start()
+    impact.current['read'].add('thing')
+    impact.passed = True
+    assert impact.stop() == {'read': ['thing'], 'write': []}
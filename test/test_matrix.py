@@ -0,0 +1,62 @@
+#pylint: disable=missing-docstring
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from . import matrix
+
+
+def item(nodeid, callspec_id):
+    return SimpleNamespace(nodeid=nodeid,
+                           callspec=SimpleNamespace(id=callspec_id))
+
+
+def test_parse():
+    assert matrix.parse(['psycopg2,sqlite', 'pg8000']) == [
+        'psycopg2', 'sqlite', 'pg8000']
+    with pytest.raises(ValueError):
+        matrix.parse(['psycopg2,mysql'])
+
+
+def test_base_id_drops_driver():
+    assert matrix.base_id(item('t.py::test_a[sqlite]', 'sqlite'),
+                          'sqlite') == 't.py::test_a'
+    assert matrix.base_id(item('t.py::test_a[sqlite-x1-y0]', 'sqlite-x1-y0'),
+                          'sqlite') == 't.py::test_a[x1-y0]'
+
+
+def test_results_keep_worst_outcome_and_total_time():
+    results = matrix.Results(['psycopg2', 'sqlite'])
+    results.add('t.py::test_a', 'sqlite', 'passed', 0.001)
+    results.add('t.py::test_a', 'sqlite', 'failed', 0.002)
+    results.add('t.py::test_a', 'sqlite', 'passed', 0.003)
+    results.add('t.py::test_a', 'psycopg2', 'skipped', 0.0)
+    outcome, db_time = results.tests['t.py::test_a']['sqlite']
+    assert outcome == 'failed'
+    assert db_time == pytest.approx(0.006)
+    lines = list(results.lines())
+    assert len(lines) == 3
+    assert lines[1].split() == ['t.py::test_a', 'skipped', '0.0ms',
+                                'failed', '6.0ms']
+    assert lines[2].split() == ['total', '0.0ms', '6.0ms']
+
+
+def test_only_the_test_thread_counts(monkeypatch):
+    # keep the DB time of this very test
+    monkeypatch.setattr(matrix, 'elapsed', matrix.elapsed)
+    monkeypatch.setattr(matrix, 'thread', matrix.thread)
+    matrix.start()
+    conn = SimpleNamespace(info={})
+
+    def execute():
+        matrix.before_cursor_execute(conn, None, 'SELECT 1', (), None, False)
+        matrix.after_cursor_execute(conn, None, 'SELECT 1', (), None, False)
+
+    worker = threading.Thread(target=execute)
+    worker.start()
+    worker.join()
+    assert matrix.elapsed == 0.0
+    execute()
+    assert matrix.elapsed > 0.0
@@ -0,0 +1,90 @@
+#pylint: disable=missing-docstring
+
+from types import SimpleNamespace
+
+from . import plans
+
+SELECT = 'SELECT thing.id FROM thing WHERE thing.name = %(name)s'
+
+
+def node(node_type, relation=None, index=None, children=(), cost=1.0):
+    found = {'Node Type': node_type, 'Total Cost': cost, 'Plan Rows': 1,
+             'Plans': list(children)}
+    if relation is not None:
+        found['Relation Name'] = relation
+    if index is not None:
+        found['Index Name'] = index
+    return found
+
+
+def plan(root):
+    return {'shape': plans.shape(root), 'cost': root['Total Cost']}
+
+
+INDEX_PLAN = plan(node('Limit', cost=8.3, children=[
+    node('Index Scan', 'thing', 'ix_thing_name', cost=8.3)]))
+SEQ_PLAN = plan(node('Limit', cost=8.1, children=[
+    node('Seq Scan', 'thing', cost=8.1)]))
+
+
+def test_shape_drops_estimates():
+    assert INDEX_PLAN['shape'] == {
+        'node': 'Limit', 'relation': None, 'index': None, 'children': [{
+            'node': 'Index Scan', 'relation': 'thing',
+            'index': 'ix_thing_name', 'children': [],
+        }],
+    }
+
+
+def test_compare_unchanged_plan_passes():
+    assert plans.compare(INDEX_PLAN, INDEX_PLAN, 2.0) == []
+
+
+def test_compare_flags_index_scan_becoming_seq_scan():
+    assert plans.compare(INDEX_PLAN, SEQ_PLAN, 2.0) == [
+        'thing: index scan became seq scan']
+
+
+def test_compare_flags_cost_above_factor():
+    costly = dict(INDEX_PLAN, cost=20.0)
+    assert plans.compare(INDEX_PLAN, dict(INDEX_PLAN, cost=16.0), 2.0) == []
+    assert plans.compare(INDEX_PLAN, costly, 2.0) == [
+        'cost 20.00 exceeds baseline 8.30 * 2.0']
+
+
+def baselines(tmpdir, monkeypatch, mode, explained, stored=None):
+    path = tmpdir.join('plans.json')
+    if stored is not None:
+        plans.Baselines(str(path), 'update', 2.0).save(stored)
+    monkeypatch.setattr(plans, 'explain', lambda conn, statement, params: explained)
+    conn = SimpleNamespace(engine=SimpleNamespace(
+        dialect=SimpleNamespace(dbapi=SimpleNamespace(Error=Exception))))
+    found = plans.Baselines(str(path), mode, 2.0)
+    return found, found.check(conn, {SELECT: {'name': 'x'}})
+
+
+def test_baselines_check_flags_regression(tmpdir, monkeypatch):
+    _, (problems, missing) = baselines(tmpdir, monkeypatch, 'fail', SEQ_PLAN,
+                                       stored={SELECT: INDEX_PLAN})
+    assert problems == ['thing: index scan became seq scan\n    ' + SELECT]
+    assert missing == []
+
+
+def test_baselines_check_passes_unchanged_plan(tmpdir, monkeypatch):
+    _, result = baselines(tmpdir, monkeypatch, 'fail', INDEX_PLAN,
+                          stored={SELECT: INDEX_PLAN})
+    assert result == ([], [])
+
+
+def test_baselines_check_without_file_reports_missing(tmpdir, monkeypatch):
+    found, result = baselines(tmpdir, monkeypatch, 'fail', SEQ_PLAN)
+    assert result == ([], [SELECT])
+    assert found.changed == {}
+
+
+def test_baselines_update_records_plans(tmpdir, monkeypatch):
+    found, result = baselines(tmpdir, monkeypatch, 'update', SEQ_PLAN,
+                              stored={SELECT: INDEX_PLAN})
+    assert result == ([], [])
+    found.save()
+    assert plans.Baselines(found.path, 'warn', 2.0).plans == {SELECT: SEQ_PLAN}
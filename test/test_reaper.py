@@ -0,0 +1,50 @@
+#pylint: disable=missing-docstring
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from . import reaper
+
+HOST = socket.gethostname()
+
+
+def comment(host, pid, age=0):
+    return reaper.OWNER_FORMAT % (host, pid, time.time() - age)
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+
+def test_orphaned_same_host_live_pid():
+    assert not reaper.orphaned(comment(HOST, os.getpid(), age=10 * 3600))
+
+
+def test_orphaned_same_host_dead_pid():
+    assert reaper.orphaned(comment(HOST, dead_pid()))
+
+
+def test_orphaned_other_host_by_age():
+    other = HOST + '-other'
+    assert not reaper.orphaned(comment(other, 1, age=reaper.GRACE_PERIOD - 60))
+    assert reaper.orphaned(comment(other, 1, age=reaper.GRACE_PERIOD + 60))
+
+
+def test_orphaned_needs_owner_comment():
+    assert not reaper.orphaned(None)
+    assert not reaper.orphaned('')
+    assert not reaper.orphaned('created by someone else')
+
+
+def test_wait_all_joins_pending_teardowns():
+    done = threading.Event()
+    reaper.defer('test_wait_all', lambda: (time.sleep(0.05), done.set()))
+    reaper.wait_all()
+    assert done.is_set()
+    assert 'test_wait_all' not in reaper.pending
@@ -0,0 +1,30 @@
+#pylint: disable=missing-docstring
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table
+from sqlalchemy.dialects import sqlite
+
+from . import schema
+
+
+def metadata(extra_column=False, index=False):
+    found = MetaData()
+    columns = [Column('id', Integer, primary_key=True), Column('name', String(50))]
+    if extra_column:
+        columns.append(Column('created_by', String(50)))
+    table = Table('thing', found, *columns)
+    if index:
+        Index('ix_thing_name', table.c.name)
+    return found
+
+
+def fingerprint(*args, **kwargs):
+    return schema.fingerprint(metadata(*args, **kwargs), sqlite.dialect())
+
+
+def test_fingerprint_is_stable():
+    assert fingerprint() == fingerprint()
+
+
+def test_fingerprint_changes_with_columns_and_indexes():
+    assert len({fingerprint(), fingerprint(extra_column=True),
+                fingerprint(index=True)}) == 3
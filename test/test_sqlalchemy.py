@@ -1,17 +1,19 @@
 #pylint: disable=missing-docstring,unused-argument
 
+from contextlib import contextmanager
 import functools
 from functools import partial
 import sys
 
-from sqlalchemy import inspect, insert, select, update, and_
-from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy import event, inspect, insert, select, text, update, and_
+from sqlalchemy.exc import IntegrityError, InvalidRequestError, OperationalError
 
 import pytest
 
+from . import bulk, commits, locks
 from .models import Thing
 
-from .conftest import DEFAULT_NAME, DEFAULT_CREATED_BY, EXTRA_NAME
+from .conftest import DEFAULT_NAME, DEFAULT_CREATED_BY, EXTRA_NAME, EXTRA_CREATED_BY
 
 MISSING = object()
 TABLE = Thing.__table__
@@ -65,6 +67,14 @@ def orm_count(db):
     return db.session.query(Thing).count()
 
 
+def core_count_table_streamed(db):
+    return sum(1 for _ in bulk.stream(db.connection, TABLE.select()))
+
+
+def orm_count_yield_per(db):
+    return sum(1 for _ in db.session.query(Thing).yield_per(bulk.BATCH_SIZE))
+
+
 def count_core_query_select(db):
     return db.connection.execute(select([TABLE])).rowcount
 
@@ -216,6 +226,7 @@ def runfunc(db, func):
     (core_query_table, 'created_by', DEFAULT_CREATED_BY),
     (session_query, 'created_by', DEFAULT_CREATED_BY),
 ])
+@pytest.mark.db_explain
 def test_update_existing(db, session, precheck, update, postcheck):
     runfunc(db, precheck)
     runfunc(db, update)
@@ -256,6 +267,128 @@ def test_insert(db, session, precheck, insert, postcheck):
     runfunc(db, postcheck)
 
 
+@pytest.mark.db_dialect('postgresql')
+@pytest.mark.db_timeout(lock='200ms')
+def test_lock_timeout_second_connection(db, session):
+    stmt = TABLE.update().where(TABLE.c.id == db.original_id).values(name=UPDATE1_NAME)
+    db.connection.execute(stmt)
+    with db.engine.connect() as conn:
+        with pytest.raises(OperationalError) as err:
+            conn.execute(stmt)
+    assert 'lock timeout' in str(err.value)
+
+
+@pytest.mark.db_dialect('postgresql')
+@pytest.mark.db_timeout(lock='200ms')
+def test_lock_timeout_report_names_blocking_pid(db, session):
+    holder = db.connection.execute(text('SELECT pg_backend_pid()')).scalar()
+    stmt = TABLE.update().where(TABLE.c.id == db.original_id).values(name=UPDATE1_NAME)
+    db.connection.execute(stmt)
+    with db.engine.connect() as conn:
+        with pytest.raises(OperationalError) as err:
+            conn.execute(stmt)
+    title, body = locks.report_section(err)
+    assert title == 'pg_locks before timeout'
+    assert 'blocked_by=[%d]' % holder in body
+
+
+@pytest.mark.db_dialect('postgresql')
+@pytest.mark.db_connections(n=3, snapshot=True)
+def test_session_pool_sees_seeded_state(db, session_pool):
+    futures = [session_pool.submit(lambda s: s.query(Thing).count()) for _ in range(6)]
+    assert [f.result() for f in futures] == [1] * 6
+
+
+@pytest.mark.db_dialect('postgresql')
+@pytest.mark.db_connections(n=3)
+def test_session_pool_commits_are_rolled_back(db, session_pool):
+    def insert(s, i):
+        put_(s, '%s-%d' % (INSERT_NAME, i))
+        s.commit()
+        return s.query(Thing).count()
+
+    assert list(session_pool.map(insert, range(3))) == [2, 2, 2]
+
+
+def test_session_pool_commits_were_rolled_back(db):
+    assert orm_count(db) == 1
+
+
+def test_plain_commit_before_intercepted_commit(session):
+    put_(session, EXTRA_NAME)
+    session.commit()
+    assert get(session, EXTRA_NAME)
+
+
+@pytest.mark.db_intercept_commit
+def test_intercepted_commit_survives_later_rollback(session):
+    put_(session, EXTRA_NAME)
+    session.commit()
+    session.commit()
+    put_(session, EXTRA_NAME, created_by=EXTRA_CREATED_BY)
+    session.rollback()
+    assert session.query(Thing).filter_by(name=EXTRA_NAME).count() == 1
+    interceptor = session.info['commit_interceptor']
+    assert (interceptor.commits, len(interceptor.checkpoints)) == (2, 1)
+
+
+def count_savepoints(conn, issued):
+    listeners = [
+        (name, lambda conn, *args, name=name: issued.append(name))
+        for name in ('savepoint', 'release_savepoint', 'rollback_savepoint')
+    ]
+    for name, listener in listeners:
+        event.listen(conn, name, listener)
+    try:
+        yield
+    finally:
+        for name, listener in listeners:
+            event.remove(conn, name, listener)
+
+
+@pytest.mark.db_intercept_commit
+def test_intercepted_commits_issue_one_savepoint_per_checkpoint(session):
+    issued = []
+    with contextmanager(count_savepoints)(session.connection(), issued):
+        put_(session, EXTRA_NAME)
+        session.commit()
+        put_(session, EXTRA_NAME, created_by=EXTRA_CREATED_BY)
+        session.commit()
+    assert issued == ['savepoint']
+    assert session.query(Thing).filter_by(name=EXTRA_NAME).count() == 2
+
+
+@pytest.mark.db_intercept_commit
+def test_intercepted_commit_checkpoints_are_bounded(session):
+    interceptor = session.info['commit_interceptor']
+    n = commits.MAX_CHECKPOINTS + 3
+    issued = []
+    with contextmanager(count_savepoints)(session.connection(), issued):
+        for i in range(n):
+            put_(session, '%s-%d' % (INSERT_NAME, i))
+            session.commit()
+        # the write after each of the n commits stacks a checkpoint
+        put_(session, EXTRA_NAME)
+        session.rollback()
+    assert len(interceptor.checkpoints) == commits.MAX_CHECKPOINTS
+    assert issued.count('savepoint') == n
+    assert issued.count('release_savepoint') == n - commits.MAX_CHECKPOINTS
+    assert session.query(Thing).filter(Thing.name.like(INSERT_NAME + '-%')) \
+        .count() == n
+    assert not get(session, EXTRA_NAME)
+
+
+def test_intercepted_commit_was_rolled_back(session):
+    assert not get(session, EXTRA_NAME)
+
+
+@pytest.mark.db_rows(200000)
+@pytest.mark.memory_limit(traced='32MB')
+@pytest.mark.parametrize('count', [core_count_table_streamed, orm_count_yield_per])
+def test_stream_large_dataset(db, bulk_things, count):
+    assert count(db) == bulk_things + 1
+
+
 # def pytest_generate_tests(metafunc):
 #     func = metafunc.function
 #     idlist = []
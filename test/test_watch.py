@@ -0,0 +1,46 @@
+#pylint: disable=missing-docstring
+
+import importlib
+import sys
+
+import pytest
+
+from . import watch
+
+MODULES = {
+    '__init__.py': '',
+    'models.py': (
+        'import json\n'
+        'from types import SimpleNamespace\n'
+        'Base = SimpleNamespace()\n'
+        'def uninstall(engine):\n'
+        '    engine.append(__name__)\n'
+    ),
+    'by_module.py': 'from . import models\n',
+    'by_identity.py': 'from .models import Base\n',
+    'unrelated.py': 'from json import dumps\nfrom .models import json\n',
+}
+
+
+@pytest.fixture
+def package(tmpdir, monkeypatch):
+    root = tmpdir.mkdir('watched_pkg')
+    for name, source in MODULES.items():
+        root.join(name).write(source)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    for name in MODULES:
+        if name != '__init__.py':
+            importlib.import_module('watched_pkg.' + name[:-3])
+    yield root
+    for name in list(sys.modules):
+        if name.split('.')[0] == 'watched_pkg':
+            del sys.modules[name]
+
+
+def test_purge_follows_imports_and_objects(package):
+    engines = [[]]
+    stale = watch.purge([str(package.join('models.py'))], engines)
+    assert stale == {'watched_pkg.models', 'watched_pkg.by_module',
+                     'watched_pkg.by_identity'}
+    assert 'watched_pkg.unrelated' in sys.modules
+    assert engines == [['watched_pkg.models']]
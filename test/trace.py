@@ -0,0 +1,139 @@
+"""
+Chrome trace / Perfetto timeline of transactions, savepoints and statements.
+
+Events are recorded from engine and session events and from the pytest
+setup/call/teardown phases. Each process (xdist worker) gets its own
+track group, with one track per DBAPI connection plus tracks for pytest
+phases and ORM session transactions. Load the written JSON file in
+chrome://tracing or https://ui.perfetto.dev.
+"""
+import json
+import os
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm.session import Session
+
+PYTEST_TID = 0
+SESSION_TID = 1
+
+# Trace being recorded, or None when tracing is off
+current = None
+
+
+def now():
+    return time.time() * 1e6
+
+
+class Trace:
+
+    def __init__(self, process_name):
+        self.pid = os.getpid()
+        self.events = []
+        self.tids = {}
+        self.metadata('process_name', PYTEST_TID, process_name)
+        self.metadata('thread_name', PYTEST_TID, 'pytest')
+        self.metadata('thread_name', SESSION_TID, 'orm sessions')
+
+    def metadata(self, name, tid, value):
+        self.events.append({
+            'name': name, 'ph': 'M', 'pid': self.pid, 'tid': tid,
+            'args': {'name': value},
+        })
+
+    def tid(self, conn):
+        """Return track id for the DBAPI connection behind `conn`."""
+        key = id(conn.connection.connection)
+        if key not in self.tids:
+            self.tids[key] = len(self.tids) + 2
+            self.metadata('thread_name', self.tids[key],
+                          'connection %d' % (len(self.tids)))
+        return self.tids[key]
+
+    def instant(self, name, tid, **args):
+        self.events.append({
+            'name': name, 'ph': 'i', 's': 't', 'ts': now(),
+            'pid': self.pid, 'tid': tid, 'args': args,
+        })
+
+    def complete(self, name, tid, start, **args):
+        self.events.append({
+            'name': name, 'ph': 'X', 'ts': start, 'dur': now() - start,
+            'pid': self.pid, 'tid': tid, 'args': args,
+        })
+
+
+def write(path, events):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def transaction_listener(name):
+    def listener(conn, *args):
+        if current is not None:
+            savepoint = args[0] if args else None
+            current.instant(name, current.tid(conn), savepoint=savepoint)
+    return listener
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current is not None:
+        conn.info.setdefault('sqlalch_trace', []).append(now())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('sqlalch_trace')
+    if current is not None and starts:
+        current.complete(statement.split(None, 1)[0].upper(),
+                         current.tid(conn), starts.pop(),
+                         statement=statement)
+
+
+LISTENERS = dict(
+    {name: transaction_listener(name) for name in (
+        'begin', 'commit', 'rollback', 'savepoint',
+        'release_savepoint', 'rollback_savepoint',
+    )},
+    before_cursor_execute=before_cursor_execute,
+    after_cursor_execute=after_cursor_execute,
+)
+
+
+def after_transaction_create(session, transaction):
+    if current is not None:
+        current.instant('session begin_nested' if transaction.nested
+                        else 'session begin', SESSION_TID,
+                        session=id(session), transaction=id(transaction))
+
+
+def after_transaction_end(session, transaction):
+    if current is not None:
+        current.instant('session end_nested' if transaction.nested
+                        else 'session end', SESSION_TID,
+                        session=id(session), transaction=id(transaction))
+
+
+SESSION_LISTENERS = {
+    'after_transaction_create': after_transaction_create,
+    'after_transaction_end': after_transaction_end,
+}
+
+
+def install(engine):
+    """
+    Record connection-level transaction events and statements on `engine`,
+    and transaction events of all ORM sessions.
+    """
+    for target, listeners in ((engine, LISTENERS), (Session, SESSION_LISTENERS)):
+        for name, listener in listeners.items():
+            if not event.contains(target, name, listener):
+                event.listen(target, name, listener)
+
+
+def uninstall(engine):
+    for target, listeners in ((engine, LISTENERS), (Session, SESSION_LISTENERS)):
+        for name, listener in listeners.items():
+            if event.contains(target, name, listener):
+                event.remove(target, name, listener)
@@ -0,0 +1,156 @@
+"""
+Warm watch mode: rerun the tests in one long-lived process on file changes.
+
+    python -m test.watch [pytest args]
+
+Unlike `--looponfail`, which starts a fresh subprocess for every run, the
+engine and its connection pool stay alive between runs, only changed
+modules (and the modules that imported from them) are re-imported, and
+tables are only dropped and created again when `Base.metadata` changed
+(see `--db-keep-schema`).
+"""
+import configparser
+import importlib
+import os
+import sys
+import time
+import types
+
+import pytest
+
+POLL_INTERVAL = 0.2
+
+
+class WarmPlugin:
+    """Plugin handing warm engines to the `engine` and `db` fixtures."""
+
+    def __init__(self):
+        self.engines = {}  # by driver (see `--db-drivers`)
+
+    def pytest_configure(self, config):
+        config.sqlalch_warm = self
+
+
+def looponfailroots(rootdir):
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(rootdir, 'pytest.ini'))
+    roots = parser.get('pytest', 'looponfailroots', fallback='test').split()
+    return [os.path.join(rootdir, root) for root in roots]
+
+
+def scan(roots):
+    """Return {path: mtime} for python files under `roots`."""
+    mtimes = {}
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if name.endswith('.py'):
+                    path = os.path.join(dirpath, name)
+                    mtimes[path] = os.stat(path).st_mtime
+    return mtimes
+
+
+def wait_for_change(roots, mtimes):
+    """Block until a file under `roots` changes; return (changed, mtimes)."""
+    while True:
+        time.sleep(POLL_INTERVAL)
+        current = scan(roots)
+        changed = {path for path in set(current) | set(mtimes)
+                   if current.get(path) != mtimes.get(path)}
+        if changed:
+            return changed, current
+
+
+# values of these types are shared too freely to tell who imported whom
+SHARED_TYPES = (bool, int, float, complex, str, bytes, tuple, frozenset,
+                type(None))
+
+
+def imported_names(module):
+    """Yield names of modules that `module` imported itself or names from."""
+    for value in vars(module).values():
+        if isinstance(value, types.ModuleType):
+            # a package's own submodules are not imports of the package
+            if not value.__name__.startswith(module.__name__ + '.'):
+                yield value.__name__
+        else:
+            yield getattr(value, '__module__', None)
+
+
+def owned_objects(modules, stale, packages):
+    """
+    Return ids of the objects created by the `stale` modules themselves.
+
+    Such an object (e.g. `Base = declarative_base()`) can have the
+    `__module__` of the library that made it, so modules importing it are
+    found by identity instead. Objects that also appear in a module outside
+    `packages`, or in a module that a stale module imported from, were
+    imported from there rather than created by a stale module.
+    """
+    foreign = {id(value) for name, module in modules.items()
+               if name.split('.')[0] not in packages
+               for value in vars(module).values()}
+    owned = set()
+    for name in stale:
+        namespace = vars(modules[name])
+        imported = {id(value) for other in set(imported_names(modules[name]))
+                    if other in modules and other not in stale
+                    for value in vars(modules[other]).values()}
+        owned.update(id(value) for value in namespace.values()
+                     if not isinstance(value, (types.ModuleType,) + SHARED_TYPES)
+                     and id(value) not in foreign and id(value) not in imported)
+    return owned
+
+
+def depends(module, stale, owned):
+    return bool(stale.intersection(imported_names(module))) or any(
+        id(value) in owned for value in vars(module).values())
+
+
+def purge(paths, engines=()):
+    """
+    Remove modules loaded from `paths` from `sys.modules`, along with the
+    modules that imported them, so that the next run imports them again.
+
+    A removed module's `uninstall(engine)`, if any, is called for each of
+    `engines` first, so that listeners of the old module don't stay behind
+    on engines that outlive it.
+    """
+    paths = {os.path.abspath(path) for path in paths}
+    modules = {name: module for name, module in list(sys.modules.items())
+               if getattr(module, '__file__', None)}
+    stale = {name for name, module in modules.items()
+             if os.path.abspath(module.__file__) in paths}
+    packages = {name.split('.')[0] for name in stale}
+    while True:
+        owned = owned_objects(modules, stale, packages)
+        more = {name for name, module in modules.items()
+                if name not in stale and name.split('.')[0] in packages
+                and depends(module, stale, owned)}
+        if not more:
+            break
+        stale |= more
+    for name in stale:
+        uninstall = getattr(modules[name], 'uninstall', None)
+        if callable(uninstall):
+            for engine in engines:
+                uninstall(engine)
+        del sys.modules[name]
+    importlib.invalidate_caches()
+    return stale
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    roots = looponfailroots(os.getcwd())
+    plugin = WarmPlugin()
+    mtimes = scan(roots)
+    while True:
+        pytest.main(['--db-keep-schema'] + args, plugins=[plugin])
+        print('\n### watching %s for changes' % ' '.join(roots))
+        changed, mtimes = wait_for_change(roots, mtimes)
+        purge(changed, plugin.engines.values())
+
+
+if __name__ == '__main__':
+    main()